@@ -0,0 +1,55 @@
+""" Benchmarks of GeoTIFFs written by utils/array_to_geotiff.py, run from the
+notebooks directory, e.g. in a notebook to compare outputs written with and
+without CFSI_COG:
+
+    from benchmarks.geotiff import benchmark_read
+"""
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+import gdal
+gdal.UseExceptions()
+
+
+def benchmark_read(file_names: Sequence[str], window_size: int = 512, windows: int = 20,
+                   repeats: int = 3) -> List[Dict]:
+    """ Time a full read of all bands and reads of random window_size windows from
+    each file, e.g. the same data written with and without cog. Returns the best
+    of repeats in seconds, with the file size in bytes. """
+    results = []
+    cache_max = gdal.GetCacheMax()
+    gdal.SetCacheMax(0)  # no reads served from the block cache of a previous repeat
+    try:
+        for file_name in file_names:
+            results.append(_benchmark_file(file_name, window_size, windows, repeats))
+    finally:
+        gdal.SetCacheMax(cache_max)
+    return results
+
+
+def _benchmark_file(file_name: str, window_size: int, windows: int, repeats: int) -> Dict:
+    dataset = gdal.Open(file_name)
+    rows, cols = dataset.RasterYSize, dataset.RasterXSize
+    rng = np.random.default_rng(0)
+    offsets = [(int(rng.integers(0, max(cols - window_size, 0) + 1)),
+                int(rng.integers(0, max(rows - window_size, 0) + 1))) for _ in range(windows)]
+    dataset = None
+    full_times, window_times = [], []
+    for _ in range(repeats):
+        dataset = gdal.Open(file_name)
+        start = time.perf_counter()
+        dataset.ReadAsArray()
+        full_times.append(time.perf_counter() - start)
+        dataset = gdal.Open(file_name)
+        start = time.perf_counter()
+        for x, y in offsets:
+            dataset.ReadAsArray(x, y, min(window_size, cols), min(window_size, rows))
+        window_times.append(time.perf_counter() - start)
+        dataset = None
+    return {
+        "file_name": file_name,
+        "bytes": gdal.VSIStatL(file_name).size,
+        "full_read_seconds": min(full_times),
+        "window_read_seconds": min(window_times) / windows,
+    }
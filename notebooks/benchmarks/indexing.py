@@ -0,0 +1,211 @@
+""" Benchmarks of the L1C indexing stages and the S3 client of index_l1c.py, run
+from the notebooks directory, e.g. against moto's S3 server with 50 ms added to
+each fetched GET:
+
+    python -m benchmarks.indexing --latency 0.05 path/to/metadata.xml ...
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+from index_l1c import GUARDIAN, S3_ENDPOINT_URL, S3_MAX_POOL_CONNECTIONS, _GRID_FIELDS, _TILE_FIELDS, _finish_tile_metadata, \
+    _new_tile_metadata, create_s3_client, fetch_metadata, fetch_stage, get_s3_client, parse_tile_metadata
+
+LOCAL_S3_BUCKET = "sentinel-s2-l1c-benchmark"
+LOCAL_S3_PORT = int(os.environ.get("LOCAL_S3_PORT", 5000))
+
+
+def start_local_s3(bucket_name: str, objects: Dict[str, bytes], port: int = LOCAL_S3_PORT) -> Tuple[object, str]:
+    """ Start moto's S3 server in a thread and upload objects by key to bucket_name.
+    Returns the server, to be stopped with server.stop(), and its endpoint url.
+    Needs moto[server]. """
+    from moto.server import ThreadedMotoServer
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    endpoint_url = f"http://127.0.0.1:{port}"
+    s3_client = create_s3_client(endpoint_url=endpoint_url)
+    s3_client.create_bucket(Bucket=bucket_name,
+                            CreateBucketConfiguration={"LocationConstraint": "eu-central-1"})
+    for key, body in objects.items():
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+    return server, endpoint_url
+
+
+def get_local_keys(paths: List[Path]) -> Dict[str, bytes]:
+    """ metadata.xml files by L1C key, one key per file """
+    return {f"tiles/35/P/PM/2020/10/{idx + 1}/0/metadata.xml": Path(path).read_bytes()
+            for idx, path in enumerate(paths)}
+
+
+def read_tile_metadata_xpath(data: ElementTree.Element) -> dict:
+    """ Read tile metadata with one XPath scan of the tree per field, as it was
+    read before read_tile_metadata """
+    metadata = _new_tile_metadata()
+    for path, (name, parser) in _TILE_FIELDS.items():
+        metadata[name] = parser(data.find("./*/" + "/".join(path)).text)
+    for resolution, grid in metadata["grids"].items():
+        for (section, parent, field), (name, parser) in _GRID_FIELDS.items():
+            grid[name] = parser(data.findall(f"./*/{section}/{parent}[@resolution='{resolution}']/{field}")[0].text)
+    return _finish_tile_metadata(metadata)
+
+
+def benchmark_parse(paths: List[Path], repeats: int = 3) -> List[dict]:
+    """ Time reading tile metadata from a corpus of metadata.xml files with the
+    XPath scans on a decoded document, as before parse_tile_metadata, and with
+    parse_tile_metadata. Returns the best of repeats in docs per second and
+    whether each reader matches the XPath reader on every file. """
+    raws = [Path(path).read_bytes() for path in paths]
+    readers = {
+        "xpath": lambda raw: read_tile_metadata_xpath(ElementTree.fromstring(str(raw, "utf-8"))),
+        "parse_tile_metadata": parse_tile_metadata,
+    }
+    reference = [readers["xpath"](raw) for raw in raws]
+    results = []
+    for mode, reader in readers.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for raw in raws:
+                reader(raw)
+            times.append(time.perf_counter() - start)
+        seconds = min(times)
+        results.append({
+            "mode": mode,
+            "docs_per_second": len(raws) / seconds if seconds > 0 else 0.0,
+            "matches": [reader(raw) for raw in raws] == reference,
+        })
+        print(f"{mode:>19}: {results[-1]['docs_per_second']:.1f} docs/s, matches xpath: {results[-1]['matches']}")
+    return results
+
+
+def benchmark_s3_pool(bucket_name: str, keys: List[str], pool_sizes: Tuple[int, ...] = (10, 25, 50, 100),
+                      threads: int = 64, requests: int = 2000,
+                      endpoint_url: Optional[str] = S3_ENDPOINT_URL) -> List[dict]:
+    """ Stress test GETs of keys from threads sharing one client per pool size, at
+    endpoint_url if set. Returns requests per second, failed requests and the
+    number of retries per pool size. """
+    results = []
+    for pool_size in pool_sizes:
+        s3_client = create_s3_client(max_pool_connections=pool_size, endpoint_url=endpoint_url)
+        retries = 0
+        lock = Lock()
+
+        def count_retries(attempts, **kwargs):
+            nonlocal retries
+            if attempts > 1:
+                with lock:
+                    retries += 1
+
+        s3_client.meta.events.register("needs-retry.s3", count_retries)
+
+        def get(idx: int) -> bool:
+            try:
+                s3_client.get_object(Bucket=bucket_name, Key=keys[idx % len(keys)],
+                                     RequestPayer="requester")["Body"].read()
+                return True
+            except Exception as e:
+                logging.warning("GET failed: %s", e)
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            succeeded = sum(executor.map(get, range(requests)))
+        elapsed = time.perf_counter() - start
+        results.append({
+            "pool_size": pool_size,
+            "requests_per_second": requests / elapsed if elapsed > 0 else 0.0,
+            "failed": requests - succeeded,
+            "retries": retries,
+        })
+        print(f"pool {pool_size:>4}, {threads} threads: {results[-1]['requests_per_second']:.1f} requests/s, "
+              f"{results[-1]['failed']} failed, {retries} retries")
+    return results
+
+
+class DelayedS3Client:
+    """ S3 client wrapper that adds a fixed latency to each GET, to emulate the
+    round trip to S3 with a local stand-in """
+
+    def __init__(self, s3_client, latency: float):
+        self.s3_client = s3_client
+        self.latency = latency
+
+    def get_object(self, **kwargs):
+        time.sleep(self.latency)
+        return self.s3_client.get_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+
+def benchmark_fetch(bucket_name: str, keys: List[str], concurrency_levels: Tuple[int, ...] = (1, 4, 8, 16, 32),
+                    s3_client=None, latency: float = 0.0) -> List[dict]:
+    """ Time fetching and parsing the metadata.xml keys one by one, as before the
+    fetch stage, and through fetch_stage with each number of GETs in flight.
+    latency is added to each GET. Returns docs per second and the speedup over
+    the serial fetch per mode. """
+    if s3_client is None:
+        s3_client = get_s3_client(max_pool_connections=max(S3_MAX_POOL_CONNECTIONS, *concurrency_levels))
+    if latency:
+        s3_client = DelayedS3Client(s3_client, latency)
+    results = []
+
+    start = time.perf_counter()
+    for key in keys:
+        fetch_metadata(s3_client, bucket_name, key)
+    serial_seconds = time.perf_counter() - start
+    results.append({"mode": "serial", "concurrency": 1, "seconds": serial_seconds})
+
+    for concurrency in concurrency_levels:
+        key_queue = Queue()
+        for key in keys:
+            key_queue.put((key, None))
+        key_queue.put(GUARDIAN)
+        doc_queue = Queue(maxsize=2 * concurrency)
+        start = time.perf_counter()
+        fetcher = Thread(target=fetch_stage, args=(s3_client, bucket_name, key_queue, doc_queue, concurrency))
+        fetcher.start()
+        while doc_queue.get()[0] != GUARDIAN:
+            pass
+        fetcher.join()
+        results.append({"mode": "fetch_stage", "concurrency": concurrency, "seconds": time.perf_counter() - start})
+
+    for result in results:
+        result["docs_per_second"] = len(keys) / result["seconds"] if result["seconds"] > 0 else 0.0
+        result["speedup"] = serial_seconds / result["seconds"] if result["seconds"] > 0 else 0.0
+        print(f"{result['mode']:>11} {result['concurrency']:>3} in flight: {result['docs_per_second']:.1f} docs/s "
+              f"({result['speedup']:.1f}x)")
+    return results
+
+
+def main(paths: List[Path], latency: float = 0.05, port: int = LOCAL_S3_PORT):
+    """ Run the benchmarks on metadata.xml files served by a local S3 stand-in """
+    benchmark_parse(paths)
+    objects = get_local_keys(paths)
+    server, endpoint_url = start_local_s3(LOCAL_S3_BUCKET, objects, port)
+    try:
+        keys = list(objects)
+        concurrency_levels = (1, 4, 8, 16, 32)
+        s3_client = create_s3_client(max_pool_connections=max(concurrency_levels), endpoint_url=endpoint_url)
+        benchmark_fetch(LOCAL_S3_BUCKET, keys, concurrency_levels, s3_client=s3_client, latency=latency)
+        benchmark_s3_pool(LOCAL_S3_BUCKET, keys, endpoint_url=endpoint_url)
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", type=Path, help="metadata.xml files to serve")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to each GET")
+    parser.add_argument("--port", type=int, default=LOCAL_S3_PORT, help="port of the local S3 server")
+    args = parser.parse_args()
+    main(args.paths, args.latency, args.port)
@@ -0,0 +1,127 @@
+""" Benchmarks and checks of mask generation in s2cloudless_masks.py, run from the
+notebooks directory, e.g. in a notebook:
+
+    from benchmarks.masks import benchmark_inference, benchmark_shadow_masks, validate_precision
+"""
+import time
+import tracemalloc
+from typing import List, Tuple
+
+import numpy as np
+from datacube.model import Dataset as ODCDataset
+from s2cloudless import S2PixelCloudDetector
+
+from s2cloudless_masks import CLOUD_THRESHOLD, DARK_PIXEL_THRESHOLD, LOGGER, OUTPUT_RESOLUTION, REFLECTANCE_DTYPE, \
+    generate_cloud_probabilities_batch, generate_cloud_shadow_masks, generate_masks, get_cloud_detector, \
+    get_shadow_shift, load_granule
+
+MAX_MASK_DIFFERENCE = 0.001  # fraction of pixels allowed to differ from float64 masks
+
+
+def validate_precision(datasets: List[ODCDataset], dtype: str = "float32",
+                       max_difference: float = MAX_MASK_DIFFERENCE) -> List[dict]:
+    """ Compare masks generated with dtype reflectances to masks generated with
+    float64 on whole granules. Returns the fraction of differing pixels per mask
+    and whether both are within max_difference. """
+    results = []
+    for dataset in datasets:
+        tile_props = dataset.metadata_doc["properties"]
+        ds = load_granule(dataset, memory_budget=0, resolution=OUTPUT_RESOLUTION)
+        reference = generate_masks(ds, tile_props, dtype="float64")
+        reduced = generate_masks(ds, tile_props, dtype=dtype)
+        cloud_difference, shadow_difference = (float(np.mean(ref != red)) for ref, red in zip(reference, reduced))
+        result = {
+            "id": str(dataset.id),
+            "cloud_difference": cloud_difference,
+            "shadow_difference": shadow_difference,
+            "valid": cloud_difference <= max_difference and shadow_difference <= max_difference,
+        }
+        LOGGER.info(f"{tile_props['tile_id']} {dtype} vs float64: {cloud_difference:.6f} cloud, "
+                    f"{shadow_difference:.6f} shadow pixels differ")
+        results.append(result)
+    return results
+
+
+def benchmark_inference(array: np.ndarray, batch_sizes: Tuple[int, ...] = (1, 2, 4, 8),
+                        repeats: int = 3) -> List[dict]:
+    """ Time s2cloudless inference on copies of a (1, rows, cols, 13) reflectance
+    array, e.g. a window from to_reflectance. Compares a new detector per image,
+    as before detectors were shared, to the shared detector with images batched
+    batch_size at a time. Returns the best of repeats in seconds per megapixel. """
+    megapixels = array.shape[1] * array.shape[2] / 1e6
+    results = []
+
+    def best_time(run, n_images) -> float:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return min(times) / (n_images * megapixels)
+
+    def new_detector():
+        S2PixelCloudDetector(threshold=CLOUD_THRESHOLD, all_bands=True).get_cloud_probability_maps(array)
+
+    results.append({"mode": "new_detector", "batch_size": 1, "seconds_per_megapixel": best_time(new_detector, 1)})
+    get_cloud_detector()  # load the shared model outside the timings
+    for batch_size in batch_sizes:
+        batch = [array] * batch_size
+        results.append({"mode": "shared_detector", "batch_size": batch_size,
+                        "seconds_per_megapixel": best_time(lambda: generate_cloud_probabilities_batch(batch),
+                                                           batch_size)})
+    for result in results:
+        LOGGER.info(f"{result['mode']} batch of {result['batch_size']}: "
+                    f"{result['seconds_per_megapixel']:.3f} s/megapixel")
+    return results
+
+
+def generate_cloud_shadow_masks_append(nir_array: np.ndarray, cloud_mask_array: np.ndarray,
+                                       row_shift: int, col_shift: int) -> np.ndarray:
+    """ Cloud shadow masks with padding copies and np.where temporaries, as they
+    were generated before generate_cloud_shadow_masks """
+    rows, cols = cloud_mask_array.shape
+    new_rows = np.ones((abs(row_shift), cols))
+    new_cols = np.ones((rows, abs(col_shift)))
+    if row_shift > 0:
+        shadow_mask_array = np.append(cloud_mask_array, new_rows, axis=0)[row_shift:, :]
+    else:
+        shadow_mask_array = np.append(new_rows, cloud_mask_array, axis=0)[:rows, :]
+    if col_shift < 0:
+        shadow_mask_array = np.append(new_cols, shadow_mask_array, axis=1)[:, :cols]
+    else:
+        shadow_mask_array = np.append(shadow_mask_array, new_cols, axis=1)[:, col_shift:]
+    dark_pixels = np.squeeze(np.where(nir_array <= DARK_PIXEL_THRESHOLD, 1, 0))
+    return np.where((cloud_mask_array == 0) & (shadow_mask_array == 1) & (dark_pixels == 1), 1, 0)
+
+
+def benchmark_shadow_masks(shape: Tuple[int, int] = (10980, 10980), azimuth: float = 140.0,
+                           cloud_fraction: float = 0.2, seed: int = 0) -> List[dict]:
+    """ Time generating fixed distance shadow masks for a random granule of shape,
+    full granule size by default, with the former padding implementation and with
+    generate_cloud_shadow_masks. Returns seconds and tracemalloc peak bytes of
+    each, excluding the inputs, and whether the masks are equal. """
+    rng = np.random.default_rng(seed)
+    clouds = (rng.random(shape, dtype=np.float32) < cloud_fraction).astype("byte")
+    nir = rng.random((1,) + shape, dtype=np.float32).astype(REFLECTANCE_DTYPE) * 0.3
+    tile_props = {"mean_sun_azimuth": azimuth}
+    row_shift, col_shift = get_shadow_shift(tile_props)
+    modes = {
+        "append": lambda: generate_cloud_shadow_masks_append(nir, clouds, row_shift, col_shift),
+        "in_place": lambda: generate_cloud_shadow_masks(nir, clouds, tile_props),
+    }
+    results = []
+    masks = []
+    for mode, run in modes.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        masks.append(run())
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({"mode": mode, "seconds": seconds, "peak_bytes": peak})
+        LOGGER.info(f"{mode} shadow masks of {shape[0]}x{shape[1]}: {seconds:.2f} s, "
+                    f"peak {peak / 1024 ** 2:.0f} MiB")
+    matches = bool(np.array_equal(masks[0], masks[1]))
+    for result in results:
+        result["matches"] = matches
+    return results
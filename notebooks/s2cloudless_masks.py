@@ -1,14 +1,24 @@
 from os import environ
+import json
 import logging
-from typing import Union, List
+import time
+from hashlib import md5
+from multiprocessing import cpu_count, Pool
+from itertools import groupby
+from math import gcd
+from typing import Iterator, Tuple, Union, List
 from pathlib import Path
 import datacube
-from datacube.model import Dataset as ODCDataset
+from datacube.model import Dataset as ODCDataset, Range
+from datacube.utils.geometry import GeoBox
+from affine import Affine
 import datacube.storage._read  # TODO: Remove hack to avoid circular import ImportError
 import numpy as np
-from xarray import Dataset
+from xarray import DataArray, Dataset
 from s2cloudless import S2PixelCloudDetector
-from utils.array_to_geotiff import array_to_geotiff_multiband
+from utils.array_to_geotiff import array_to_geotiff_blocks, array_to_geotiff_multiband, dataarray_blocks
+from utils.indexing import add_datasets
+from utils.manifest import Manifest
 import gdal
 gdal.UseExceptions()
 
@@ -17,8 +27,47 @@ CLOUD_THRESHOLD = 0.3  # cloud threshold value for s2cloudless
 MAX_CLOUD_THRESHOLD = 94.0  # maximum cloudiness percentage in metadata
 MIN_CLOUD_THRESHOLD = 1.0  # minimum cloudiness percentage in metadata
 CLOUD_PROJECTION_DISTANCE = 30  # maximum distance to search for cloud shadows
+# "fixed" shifts cloud masks by CLOUD_PROJECTION_DISTANCE, "geometry" searches shadows of clouds
+# between MIN_CLOUD_HEIGHT and MAX_CLOUD_HEIGHT metres from the mean sun zenith and azimuth
+SHADOW_SEARCH = environ.get("CFSI_SHADOW_SEARCH", "fixed")
+MIN_CLOUD_HEIGHT = float(environ.get("CFSI_MIN_CLOUD_HEIGHT", 500))
+MAX_CLOUD_HEIGHT = float(environ.get("CFSI_MAX_CLOUD_HEIGHT", 5000))
 DARK_PIXEL_THRESHOLD = 0.15
 WRITE_RGB = True
+# Write outputs as cloud optimised GeoTIFFs: internally tiled in OUTPUT_BLOCK_SIZE blocks,
+# compressed with OUTPUT_COMPRESS (DEFLATE, or ZSTD if GDAL supports it) and with overviews
+WRITE_COG = environ.get("CFSI_COG", "1") == "1"
+OUTPUT_COMPRESS = environ.get("CFSI_COMPRESS", "DEFLATE")
+OUTPUT_BLOCK_SIZE = int(environ.get("CFSI_BLOCK_SIZE", 512))
+# Write s2cloudless cloud probabilities to the cloud_probability band, so that masks can be
+# thresholded on load at any level without rerunning the classifier. Without it the band
+# is written as nodata, so that all datasets of a product have the same bands
+WRITE_PROBABILITY = environ.get("CFSI_WRITE_PROBABILITY", "1") == "1"
+PROBABILITY_SCALE = 254  # quantised probability = 1 + round(probability * PROBABILITY_SCALE), 0 is nodata
+# "bands" writes cloud and shadow masks as separate bands, "packed" as bit flags of a single
+# QA band. Each encoding has its own product in MASK_PRODUCTS
+MASK_ENCODING = environ.get("CFSI_MASK_ENCODING", "bands")
+# bit of each flag in the QA band, bits 2-6 are free for new flags. The valid bit is set on
+# all written pixels, so that 0 stays nodata like in the other bands
+QA_FLAGS = {"cloud": 0, "shadow": 1, "valid": 7}
+# Floating point type of reflectances given to s2cloudless, float32 halves memory use. Masks
+# can be compared to float64 masks with benchmarks.masks.validate_precision
+REFLECTANCE_DTYPE = environ.get("CFSI_REFLECTANCE_DTYPE", "float64")
+# Memory budget in bytes for processing a granule in windows, 0 processes whole granules at once
+WINDOW_MEMORY_BUDGET = int(environ.get("CFSI_WINDOW_MEMORY_BUDGET", 0))
+# reflectance bands plus s2cloudless feature and probability arrays
+WINDOW_BYTES_PER_PIXEL = 13 * np.dtype(REFLECTANCE_DTYPE).itemsize * 3
+CLASSIFIER_MARGIN = 8  # pixels affected by s2cloudless averaging and dilation at window edges
+WINDOW_OVERLAP = CLOUD_PROJECTION_DISTANCE + CLASSIFIER_MARGIN
+LOAD_CHUNK_SIZE = 1024  # dask chunk size in windowed mode so that windows are read partially
+GRANULE_PIXELS = 10980 * 10980  # 10 m pixels in a granule
+PROCESSES = int(environ.get("CFSI_PROCESSES", cpu_count()))
+# Memory budget in bytes for all granules processed in parallel, 0 limits only by PROCESSES
+MEMORY_BUDGET = int(environ.get("CFSI_MEMORY_BUDGET", 0))
+OUTPUT_RESOLUTION = 10  # resolution of the written masks in metres
+# Resolution in metres at which masks are generated before upsampling to OUTPUT_RESOLUTION,
+# a multiple of OUTPUT_RESOLUTION, e.g. 20 or 60 to match the native grids of the coarser bands
+WORKING_RESOLUTION = int(environ.get("CFSI_WORKING_RESOLUTION", OUTPUT_RESOLUTION))
 
 try:
     OUTPUT_PATH = Path(environ["CFSI_OUTPUT_DIR"])
@@ -26,6 +75,14 @@ try:
         raise Exception("Error in env. variable OUTPUT_PATH: directory does not exist")
 except KeyError:
     OUTPUT_PATH = Path("/home/mikael/tmp/cfsi_output")
+MANIFEST_PATH = Path(environ.get("CFSI_MANIFEST", OUTPUT_PATH / "manifest.sqlite"))
+MASK_PRODUCTS = {  # mask product and output file suffix by MASK_ENCODING
+    "bands": "s2a_level1c_s2cloudless",  # B01 cloud, B02 shadow, B03 cloud_probability
+    "packed": "s2a_level1c_s2cloudless_qa",  # B01 qa, B02 cloud_probability
+}
+MASK_PRODUCT = MASK_PRODUCTS[MASK_ENCODING]
+INDEX_MASKS = environ.get("CFSI_INDEX_MASKS", "1") == "1"  # index written masks as MASK_PRODUCT datasets
+INDEX_BATCH_SIZE = int(environ.get("CFSI_INDEX_BATCH_SIZE", 100))  # mask datasets per insert transaction
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -39,142 +96,785 @@ ch.setFormatter(formatter)
 LOGGER.addHandler(ch)
 
 
-def process_dataset(dataset: ODCDataset) -> (np.ndarray, np.ndarray):
-    """ Generate cloud and cloud shadow masks for a single datacube dataset """
-    tile_props = dataset.metadata_doc["properties"]
+class CloudPercentageSkip(ValueError):
+    """ Granule skipped because its metadata cloud percentage is outside the thresholds """
+
+
+def check_cloud_percentage(tile_props: dict):
+    """ Raise CloudPercentageSkip if the metadata cloud percentage is outside the thresholds """
     metadata_cloud_percentage = tile_props["cloudy_pixel_percentage"]
     if metadata_cloud_percentage > MAX_CLOUD_THRESHOLD:
         LOGGER.info("Metadata cloud percentage greater than max threshold value: " +
                     f"{MAX_CLOUD_THRESHOLD} < {metadata_cloud_percentage}")
-        raise ValueError  # TODO: add custom exception and catch
+        raise CloudPercentageSkip(f"Cloud percentage {metadata_cloud_percentage} > {MAX_CLOUD_THRESHOLD}")
     if metadata_cloud_percentage < MIN_CLOUD_THRESHOLD:
         LOGGER.info("Metadata cloud percentage lower than min threshold value: " +
                     f"{MIN_CLOUD_THRESHOLD} > {metadata_cloud_percentage}")
-        raise ValueError
+        raise CloudPercentageSkip(f"Cloud percentage {metadata_cloud_percentage} < {MIN_CLOUD_THRESHOLD}")
+
+
+def load_granule(dataset: ODCDataset,
+                 memory_budget: int = WINDOW_MEMORY_BUDGET,
+                 dc: datacube.Datacube = None,
+                 resolution: int = WORKING_RESOLUTION) -> Dataset:
+    """ Load all bands of a granule at resolution for mask generation. In windowed
+    mode the data stays lazy in chunks, otherwise it is read to memory once so
+    that it can be shared by mask generation and the rgb writer. """
+    s3_key = dataset.metadata_doc["properties"]["s3_key"]
+    if memory_budget:
+        return load_datasets([dataset], app_name=f"s2cloudless-processor_{s3_key}",
+                             dask_chunks={"x": LOAD_CHUNK_SIZE, "y": LOAD_CHUNK_SIZE}, dc=dc,
+                             resolution=resolution)
+    return load_datasets([dataset], app_name=f"s2cloudless-processor_{s3_key}", dc=dc,
+                         resolution=resolution).load()
+
+
+def get_output_geobox(geobox: GeoBox, resolution: int = OUTPUT_RESOLUTION) -> GeoBox:
+    """ Geobox of the output masks for a geobox at the working resolution """
+    factor = int(round(abs(geobox.resolution[1]) / resolution))
+    if factor == 1:
+        return geobox
+    return GeoBox(geobox.width * factor, geobox.height * factor,
+                  geobox.affine * Affine.scale(1 / factor), geobox.crs)
+
+
+def upsample_mask(mask: np.ndarray, factor: int) -> np.ndarray:
+    """ Nearest neighbour upsampling of a 2D mask by an integer factor """
+    if factor == 1:
+        return mask
+    return np.repeat(np.repeat(mask, factor, axis=0), factor, axis=1)
+
+
+def process_dataset(dataset: ODCDataset,
+                    memory_budget: int = WINDOW_MEMORY_BUDGET,
+                    ds: Dataset = None,
+                    with_probability: bool = WRITE_PROBABILITY) -> List[np.ndarray]:
+    """ Generate cloud and cloud shadow masks for a single datacube dataset,
+    followed by quantised cloud probabilities if with_probability is set.
+    With a memory budget the granule is processed in overlapping windows.
+    A granule already loaded with load_granule can be passed as ds. Masks are
+    generated at the resolution of ds and upsampled to OUTPUT_RESOLUTION. """
+    tile_props = dataset.metadata_doc["properties"]
+    check_cloud_percentage(tile_props)
+
+    LOGGER.info(f"Processing {tile_props['s3_key']}\t{tile_props['cloudy_pixel_percentage']}% cloudy")
+    if ds is None:
+        ds = load_granule(dataset, memory_budget)
+    factor = int(round(abs(ds.geobox.resolution[1]) / OUTPUT_RESOLUTION))
+    projection_distance = CLOUD_PROJECTION_DISTANCE / factor
+    if memory_budget:
+        masks = generate_masks_windowed(ds, tile_props, memory_budget,
+                                        projection_distance=projection_distance,
+                                        with_probability=with_probability)
+    else:
+        masks = generate_masks(ds, tile_props, projection_distance, with_probability=with_probability)
+    if factor > 1:
+        LOGGER.info(f"Upsampling masks by {factor}")
+        masks = [upsample_mask(mask, factor) for mask in masks]
+
+    LOGGER.info("Mask generation done")
+    return masks
+
 
-    s3_key = tile_props["s3_key"]
-    LOGGER.info(f"Processing {s3_key}\t{metadata_cloud_percentage}% cloudy")
-    ds = load_datasets([dataset], app_name=f"s2cloudless-processor_{s3_key}")
+def to_reflectance(dn_array: np.ndarray, dtype: str = REFLECTANCE_DTYPE) -> np.ndarray:
+    """ Convert a (band, time, y, x) uint16 DN array to a (time, y, x, band)
+    reflectance array of dtype, allocating the output only once """
+    array = np.moveaxis(dn_array, 0, -1).astype(dtype, order="C")
+    array /= np.dtype(dtype).type(10000)
+    return array
 
+
+def generate_masks(ds: Dataset, tile_props: dict,
+                   projection_distance: float = CLOUD_PROJECTION_DISTANCE,
+                   dtype: str = REFLECTANCE_DTYPE,
+                   with_probability: bool = False) -> List[np.ndarray]:
+    """ Generate cloud and cloud shadow masks for a loaded dataset, followed by
+    quantised cloud probabilities if with_probability is set """
     LOGGER.info("Fetching data to array")
-    array = np.moveaxis(ds.to_array().values.astype("float64") / 10000, 0, -1)
+    array = to_reflectance(ds.to_array().values, dtype)  # DN stays uint16 until here
     LOGGER.info("Generating cloud masks")
-    cloud_masks = generate_cloud_masks(array)  # TODO: evaluate performance
+    cloud_probs = generate_cloud_probabilities(array) if with_probability else None
+    cloud_masks = generate_cloud_masks(array, cloud_probs)  # TODO: evaluate performance
     LOGGER.info("Generating shadow masks")
-    shadow_masks = generate_cloud_shadow_masks(array[:, :, :, 7], cloud_masks, tile_props)  # TODO: evaluate performance
+    if SHADOW_SEARCH == "geometry":
+        shadow_masks = generate_cloud_shadow_masks_geometry(array[:, :, :, 7], cloud_masks, tile_props,
+                                                            abs(ds.geobox.resolution[1]))
+    else:
+        shadow_masks = generate_cloud_shadow_masks(array[:, :, :, 7], cloud_masks, tile_props,
+                                                   projection_distance)  # TODO: evaluate performance
+    if with_probability:
+        return [cloud_masks, shadow_masks, quantise_probability(cloud_probs)]
+    return [cloud_masks, shadow_masks]
 
-    LOGGER.info("Mask generation done")
-    return cloud_masks, shadow_masks
+
+def get_window_overlap(ds: Dataset, tile_props: dict,
+                       projection_distance: float = CLOUD_PROJECTION_DISTANCE) -> int:
+    """ Window overlap in pixels covering the shadow search and the s2cloudless filters """
+    if SHADOW_SEARCH == "geometry":
+        search_distance = get_shadow_search_range(tile_props, abs(ds.geobox.resolution[1]))[1]
+    else:
+        search_distance = int(np.ceil(projection_distance))
+    return max(search_distance + CLASSIFIER_MARGIN, WINDOW_OVERLAP)
+
+
+def get_window_size(memory_budget: int, overlap: int = WINDOW_OVERLAP, align: int = 1) -> int:
+    """ Side length of the window core that fits in memory_budget with overlap,
+    rounded down to a multiple of align if it is at least align """
+    size = int(np.sqrt(memory_budget / WINDOW_BYTES_PER_PIXEL)) - 2 * overlap
+    if size < overlap:
+        raise ValueError(f"Memory budget of {memory_budget} bytes is too small for an overlap of {overlap}")
+    if size >= align:
+        size -= size % align
+    return size
+
+
+def get_windows(rows: int, cols: int, size: int,
+                overlap: int) -> Iterator[Tuple[Tuple[slice, slice], Tuple[slice, slice], Tuple[slice, slice]]]:
+    """ Split a rows x cols grid into size x size windows. Yields the window to read,
+    including overlap, the window core relative to the read window, and the core
+    in the full grid. """
+    for row in range(0, rows, size):
+        for col in range(0, cols, size):
+            row_end, col_end = min(row + size, rows), min(col + size, cols)
+            read_row, read_col = max(row - overlap, 0), max(col - overlap, 0)
+            read_window = (slice(read_row, min(row_end + overlap, rows)),
+                           slice(read_col, min(col_end + overlap, cols)))
+            core = (slice(row - read_row, row_end - read_row), slice(col - read_col, col_end - read_col))
+            yield read_window, core, (slice(row, row_end), slice(col, col_end))
+
+
+def generate_mask_windows(ds: Dataset, tile_props: dict, memory_budget: int,
+                          overlap: int = None,
+                          projection_distance: float = CLOUD_PROJECTION_DISTANCE,
+                          with_probability: bool = False,
+                          align: int = 1) -> Iterator[Tuple[Tuple[slice, slice], List[np.ndarray]]]:
+    """ Generate cloud and cloud shadow masks, and optionally quantised cloud
+    probabilities, in overlapping windows sized to memory_budget. Yields the core
+    of each window in the granule and its masks. The overlap covers the cloud
+    shadow search distance and the s2cloudless filters, so the window cores match
+    masks computed from the whole granule. Cores are a multiple of align pixels
+    where the budget allows. """
+    rows, cols = ds.dims["y"], ds.dims["x"]
+    if overlap is None:
+        overlap = get_window_overlap(ds, tile_props, projection_distance)
+    size = get_window_size(memory_budget, overlap, align)
+    windows = list(get_windows(rows, cols, size, overlap))
+    LOGGER.info(f"Processing {rows}x{cols} granule in {len(windows)} windows of {size}x{size}")
+    for idx, (read_window, core, target) in enumerate(windows):
+        LOGGER.debug(f"Window {idx + 1}/{len(windows)}: {target}")
+        window_ds = ds.isel(y=read_window[0], x=read_window[1])
+        window_masks = generate_masks(window_ds, tile_props, projection_distance, with_probability=with_probability)
+        yield target, [mask[core] for mask in window_masks]
+
+
+def generate_masks_windowed(ds: Dataset, tile_props: dict, memory_budget: int,
+                            overlap: int = None,
+                            projection_distance: float = CLOUD_PROJECTION_DISTANCE,
+                            with_probability: bool = False) -> List[np.ndarray]:
+    """ Generate masks with generate_mask_windows and stitch them into arrays of
+    the whole granule. process_and_write writes windows to the output as they are
+    generated with write_masks_windowed instead. """
+    rows, cols = ds.dims["y"], ds.dims["x"]
+    masks = [np.zeros((rows, cols), dtype="byte"), np.zeros((rows, cols), dtype="byte")]
+    if with_probability:
+        masks.append(np.zeros((rows, cols), dtype=np.uint8))
+    for target, window_masks in generate_mask_windows(ds, tile_props, memory_budget, overlap,
+                                                      projection_distance, with_probability):
+        for mask, window_mask in zip(masks, window_masks):
+            mask[target] = window_mask
+    return masks
 
 
 def load_datasets(
         datasets: Union[List[ODCDataset], ODCDataset],
         measurements: List[str] = None,
-        app_name: str = "s2cloudless") -> Dataset:
-    """ Loads a xarray.Dataset datacube from an ODC dataset """
+        app_name: str = "s2cloudless",
+        dask_chunks: dict = None,
+        dc: datacube.Datacube = None,
+        resolution: int = OUTPUT_RESOLUTION) -> Dataset:
+    """ Loads a xarray.Dataset datacube from an ODC dataset. Bands are averaged
+    when loaded at a resolution coarser than their native grid. """
     if not isinstance(datasets, list):
         datasets = [datasets]
-    dc = datacube.Datacube(app=app_name)
+    if dc is None:
+        dc = datacube.Datacube(app=app_name)
     ds = dc.load(product="s2a_level1c_granule",
-                 dask_chunks={},
+                 dask_chunks=dask_chunks or {},
                  measurements=measurements,
                  output_crs="epsg:32635",  # TODO: read from dataset
-                 resolution=(-10, 10),  # TODO: read from dataset
+                 resolution=(-resolution, resolution),
+                 resampling="nearest" if resolution == OUTPUT_RESOLUTION else "average",
                  crs="epsg:32635",  # TODO: read from dataset
                  datasets=datasets)
     return ds
 
 
-def generate_cloud_masks(array: np.ndarray) -> np.ndarray:
-    """ Generate binary cloud masks with s2cloudless """
-    cloud_detector = S2PixelCloudDetector(threshold=CLOUD_THRESHOLD, all_bands=True)
+_cloud_detector = None
+
+
+def get_cloud_detector() -> S2PixelCloudDetector:
+    """ s2cloudless detector shared by all calls in a process, so that the
+    classifier model is loaded only once per worker """
+    global _cloud_detector
+    if _cloud_detector is None:
+        _cloud_detector = S2PixelCloudDetector(threshold=CLOUD_THRESHOLD, all_bands=True)
+    return _cloud_detector
+
+
+def generate_cloud_masks(array: np.ndarray, cloud_probs: np.ndarray = None) -> np.ndarray:
+    """ Generate binary cloud masks with s2cloudless. Masks are derived from
+    cloud probabilities computed with generate_cloud_probabilities if given,
+    instead of running the classifier again. """
+    cloud_detector = get_cloud_detector()
+    if cloud_probs is not None:
+        return np.squeeze(cloud_detector.get_mask_from_prob(cloud_probs[np.newaxis])).astype("byte")
     return np.squeeze(cloud_detector.get_cloud_masks(array)).astype("byte")
 
 
+def generate_cloud_probabilities(array: np.ndarray) -> np.ndarray:
+    """ Generate cloud probabilities with s2cloudless """
+    return np.squeeze(get_cloud_detector().get_cloud_probability_maps(array), axis=0)
+
+
+def generate_cloud_probabilities_batch(arrays: List[np.ndarray]) -> List[np.ndarray]:
+    """ Generate cloud probabilities for a batch of (1, rows, cols, 13) or
+    (rows, cols, 13) reflectance arrays, e.g. windows of several granules. Arrays
+    of the same shape are stacked into a single (n_images, rows, cols, 13) call
+    to the classifier. Returns (rows, cols) probabilities in input order. """
+    arrays = [array.reshape(array.shape[-3:]) for array in arrays]
+    cloud_probs = [None] * len(arrays)
+    by_shape = sorted(range(len(arrays)), key=lambda idx: arrays[idx].shape)
+    for _, group in groupby(by_shape, key=lambda idx: arrays[idx].shape):
+        group = list(group)
+        batch_probs = get_cloud_detector().get_cloud_probability_maps(np.stack([arrays[idx] for idx in group]))
+        for idx, probs in zip(group, batch_probs):
+            cloud_probs[idx] = probs
+    return cloud_probs
+
+
+def generate_cloud_masks_batch(arrays: List[np.ndarray]) -> List[np.ndarray]:
+    """ Generate binary cloud masks for a batch of reflectance arrays with
+    generate_cloud_probabilities_batch """
+    return [generate_cloud_masks(None, cloud_probs) for cloud_probs in generate_cloud_probabilities_batch(arrays)]
+
+
+def quantise_probability(cloud_probs: np.ndarray) -> np.ndarray:
+    """ Quantise probabilities between 0 and 1 to uint8 between 1 and
+    PROBABILITY_SCALE + 1, leaving 0 for nodata like the mask bands """
+    quantised = np.multiply(cloud_probs, PROBABILITY_SCALE, dtype=np.float32)
+    np.rint(quantised, out=quantised)
+    quantised += 1
+    return quantised.astype(np.uint8)
+
+
+def dequantise_probability(quantised: np.ndarray) -> np.ndarray:
+    """ Probabilities from quantise_probability output, nodata becomes nan """
+    cloud_probs = (quantised.astype(np.float32) - 1) / np.float32(PROBABILITY_SCALE)
+    cloud_probs[quantised == 0] = np.nan
+    return cloud_probs
+
+
+def threshold_probability(quantised: np.ndarray, threshold: float = CLOUD_THRESHOLD) -> np.ndarray:
+    """ Binary cloud mask of quantised probabilities above threshold, without the
+    averaging and dilation s2cloudless applies to its masks """
+    return quantised > 1 + threshold * PROBABILITY_SCALE
+
+
+def pack_qa(masks: dict) -> np.ndarray:
+    """ Pack binary masks by flag name into a uint8 QA band with the bits in QA_FLAGS.
+    The valid bit is set on all pixels. """
+    qa = None
+    for flag, mask in masks.items():
+        bits = np.not_equal(mask, 0).view(np.uint8)
+        np.left_shift(bits, QA_FLAGS[flag], out=bits)
+        if qa is None:
+            qa = bits
+        else:
+            np.bitwise_or(qa, bits, out=qa)
+    np.bitwise_or(qa, np.uint8(1 << QA_FLAGS["valid"]), out=qa)
+    return qa
+
+
+def encode_masks(masks: List[np.ndarray]) -> List[np.ndarray]:
+    """ Output bands of MASK_ENCODING from cloud and shadow masks, followed by
+    quantised cloud probabilities if generated. Without them the cloud_probability
+    band is written as nodata. """
+    if len(masks) == 2:
+        masks = masks + [np.zeros(masks[0].shape, dtype=np.uint8)]
+    if MASK_ENCODING == "packed":
+        masks = [pack_qa({"cloud": masks[0], "shadow": masks[1]})] + masks[2:]
+    return masks
+
+
+def unpack_qa(qa: np.ndarray, flags: List[str] = None) -> dict:
+    """ Boolean masks by flag name from a QA band, all flags in QA_FLAGS unless given """
+    return {flag: np.bitwise_and(qa, 1 << QA_FLAGS[flag]) != 0 for flag in flags or QA_FLAGS}
+
+
+def _shift_slices(size: int, shift: int) -> (slice, slice):
+    """ Destination and source slices for out[i] = src[i + shift] along one axis """
+    shift = max(-size, min(size, shift))
+    return slice(max(-shift, 0), size - max(shift, 0)), slice(max(shift, 0), size - max(-shift, 0))
+
+
+def shift_mask(mask: np.ndarray, row_shift: int, col_shift: int,
+               fill: bool = True, out: np.ndarray = None) -> np.ndarray:
+    """ Shift a 2D boolean mask so that out[i, j] = mask[i + row_shift, j + col_shift].
+    Pixels shifted in from outside the mask are set to fill. Writes to out if given. """
+    rows, cols = mask.shape
+    if out is None:
+        out = np.empty((rows, cols), dtype=bool)
+    dst_rows, src_rows = _shift_slices(rows, row_shift)
+    dst_cols, src_cols = _shift_slices(cols, col_shift)
+    out[dst_rows, dst_cols] = mask[src_rows, src_cols]
+    out[:dst_rows.start, :] = fill
+    out[dst_rows.stop:, :] = fill
+    out[:, :dst_cols.start] = fill
+    out[:, dst_cols.stop:] = fill
+    return out
+
+
 def generate_cloud_shadow_masks(nir_array: np.ndarray,
                                 cloud_mask_array: np.ndarray,
-                                tile_props: dict) -> np.ndarray:
-    """ Generate binary cloud shadow masks """
+                                tile_props: dict,
+                                projection_distance: float = CLOUD_PROJECTION_DISTANCE,
+                                out: np.ndarray = None) -> np.ndarray:
+    """ Generate binary uint8 cloud shadow masks, projection_distance in pixels.
+    Dark pixels that are not cloudy but have a cloud projection_distance away
+    towards the sun azimuth are marked as shadow. Works on boolean arrays with
+    a single extra buffer; the result is written to the bool buffer out if given. """
+    row_shift, col_shift = get_shadow_shift(tile_props, projection_distance)
+    clouds = _as_bool_mask(cloud_mask_array)
+    shadows = shift_mask(clouds, row_shift, col_shift, fill=True, out=out)
+    return _combine_shadow_candidates(shadows, clouds, nir_array)
+
+
+def _as_bool_mask(cloud_mask_array: np.ndarray) -> np.ndarray:
+    """ Boolean cloud mask, a view of 0/1 byte masks from generate_cloud_masks """
+    if cloud_mask_array.dtype.itemsize == 1:
+        return cloud_mask_array.view(bool)
+    return cloud_mask_array != 0
+
+
+def _combine_shadow_candidates(shadows: np.ndarray, clouds: np.ndarray, nir_array: np.ndarray) -> np.ndarray:
+    """ Keep the dark, not cloudy pixels of the boolean shadow candidates in place
+    and return them as a binary uint8 mask """
+    buffer = np.less_equal(np.squeeze(nir_array), DARK_PIXEL_THRESHOLD)  # dark pixels
+    np.logical_and(shadows, buffer, out=shadows)
+    np.logical_not(clouds, out=buffer)
+    np.logical_and(shadows, buffer, out=shadows)
+    return shadows.view(np.uint8)
+
+
+def get_shadow_shift(tile_props: dict, projection_distance: float = CLOUD_PROJECTION_DISTANCE) -> (int, int):
+    """ Rows and columns to shift cloud masks by to project them onto shadows.
+    Uses the same direction as generate_cloud_shadow_masks_geometry. """
     az = np.deg2rad(tile_props["mean_sun_azimuth"])
-    rows, cols = cloud_mask_array.shape
-    # calculate how many rows/cols to shift cloud shadow masks
-    x = np.math.cos(az)
-    y = np.math.sin(az)
-    x *= CLOUD_PROJECTION_DISTANCE
-    y *= CLOUD_PROJECTION_DISTANCE
-
-    new_rows = np.zeros((abs(int(y)), cols))
-    new_cols = np.zeros((rows, abs(int(x))))
-    new_rows[:] = 1
-    new_cols[:] = 1
-
-    if y > 0:
-        shadow_mask_array = np.append(cloud_mask_array, new_rows, axis=0)[int(y):, :]
-    else:
-        shadow_mask_array = np.append(new_rows, cloud_mask_array, axis=0)[:int(y), :]
-    if x < 0:
-        shadow_mask_array = np.append(new_cols, shadow_mask_array, axis=1)[:, :int(x)]
-    else:
-        shadow_mask_array = np.append(shadow_mask_array, new_cols, axis=1)[:, int(x):]
+    # clouds lie towards the sun from their shadows, azimuth is clockwise from north
+    row_shift = int(-np.cos(az) * projection_distance)  # rows grow southwards
+    col_shift = int(np.sin(az) * projection_distance)  # columns grow eastwards
+    return row_shift, col_shift
+
+
+def get_shadow_search_range(tile_props: dict, pixel_size: float) -> (int, int):
+    """ Minimum and maximum shadow distance in pixels from clouds between
+    MIN_CLOUD_HEIGHT and MAX_CLOUD_HEIGHT at the mean sun zenith angle """
+    tan_zenith = np.tan(np.deg2rad(tile_props["mean_sun_zenith"]))
+    return (int(MIN_CLOUD_HEIGHT * tan_zenith / pixel_size),
+            int(np.ceil(MAX_CLOUD_HEIGHT * tan_zenith / pixel_size)))
+
 
-    dark_pixels = np.squeeze(np.where(nir_array <= DARK_PIXEL_THRESHOLD, 1, 0))
-    LOGGER.debug("shapes")
-    LOGGER.debug("cloud mask\t\tshadow_mask\t\tdark_pixels")
-    LOGGER.debug(f"{cloud_mask_array.shape}\t{shadow_mask_array.shape}\t\t{dark_pixels.shape}")
-    return np.where((cloud_mask_array == 0) & (shadow_mask_array == 1) & (dark_pixels == 1), 1, 0)
+def directional_dilation(mask: np.ndarray, direction: Tuple[float, float],
+                         min_distance: float, max_distance: float, fill: bool = True) -> np.ndarray:
+    """ Dilate a 2D boolean mask along a line: out[p] is True if mask is True at any
+    p + k * direction for k between min_distance and max_distance pixels. Outside
+    the mask counts as fill. The line is rasterised exactly along its major axis
+    and to within a pixel across it.
+    The mask is sheared so that the line becomes a column, where the sweep over all
+    distances takes log2 of the number of distances passes instead of one shifted
+    copy per distance. """
+    row_step, col_step = np.asarray(direction, dtype=float) / np.hypot(*direction)
+    out = np.empty(mask.shape, dtype=bool)
+    src, dst = mask, out
+    if abs(col_step) > abs(row_step):  # make rows the major axis
+        src, dst = src.T, dst.T
+        row_step, col_step = col_step, row_step
+    if row_step < 0:
+        src, dst = src[::-1], dst[::-1]
+        row_step = -row_step
+    slope = col_step / row_step  # columns per row, at most 1
+    min_distance = int(np.floor(min_distance * row_step))  # in rows along the major axis
+    max_distance = int(np.ceil(max_distance * row_step))
+    rows, cols = src.shape
+
+    # sheared[i, offsets[i] + j] = src[i, j], so src[i + k, j + k * slope] is in column offsets[i] + j
+    offsets = -np.round(np.arange(rows) * slope).astype(int)
+    offsets -= offsets.min()
+    sheared = np.full((rows + max_distance, cols + offsets.max()), fill, dtype=bool)
+    for i in range(rows):
+        sheared[i, offsets[i]:offsets[i] + cols] = src[i]
+
+    # sheared[i] |= sheared[i + 1] | ... | sheared[i + length - 1] by doubling the span
+    length = max_distance - min_distance + 1
+    span = 1
+    while span * 2 <= length:
+        sheared[:-span] |= sheared[span:]
+        span *= 2
+    if length > span:
+        sheared[:span - length] |= sheared[length - span:]
+
+    for i in range(rows):
+        dst[i] = sheared[i + min_distance, offsets[i]:offsets[i] + cols]
+    return out
+
+
+def generate_cloud_shadow_masks_geometry(nir_array: np.ndarray,
+                                         cloud_mask_array: np.ndarray,
+                                         tile_props: dict,
+                                         pixel_size: float) -> np.ndarray:
+    """ Generate binary uint8 cloud shadow masks from sun geometry. Dark pixels
+    that are not cloudy are marked as shadow if a cloud at any height between
+    MIN_CLOUD_HEIGHT and MAX_CLOUD_HEIGHT would cast a shadow on them. """
+    az = np.deg2rad(tile_props["mean_sun_azimuth"])
+    min_distance, max_distance = get_shadow_search_range(tile_props, pixel_size)
+    # clouds lie towards the sun from their shadows, azimuth is clockwise from north
+    direction = (-np.cos(az), np.sin(az))  # rows grow southwards, columns eastwards
+    clouds = _as_bool_mask(cloud_mask_array)
+    shadows = directional_dilation(clouds, direction, min_distance, max_distance, fill=True)
+    return _combine_shadow_candidates(shadows, clouds, nir_array)
+
+
+def get_output_path(dataset: ODCDataset, file_suffix: str) -> str:
+    """ Output .tif path of a dataset, creating its directory """
+    tile_props = dataset.metadata_doc["properties"]
+    output_dir = Path(OUTPUT_PATH / tile_props["s3_key"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return str(Path(output_dir / f"{tile_props['tile_id']}_{file_suffix}.tif"))
 
 
 def write_to_tif(
         dataset: ODCDataset,
         data: List[np.ndarray],
         data_type: int = gdal.GDT_Byte,
-        file_suffix: str = "s2cloudless"):
-    """ Write a set of ndarrays to .tif """
-    tile_props = dataset.metadata_doc["properties"]
-    tile_path = Path(tile_props["s3_key"])
-    tile_id = tile_props["tile_id"]
-    output_dir = Path(OUTPUT_PATH / tile_path)
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    ds = load_datasets(dataset, app_name=f"s2cloudless-writer_{tile_path}")
-    geo_transform = ds.geobox.transform.to_gdal()
-    projection = ds.geobox.crs.wkt
+        file_suffix: str = "s2cloudless",
+        geobox: GeoBox = None) -> str:
+    """ Write a set of ndarrays to .tif. The geobox is read from the index
+    unless given. Returns the output path. """
+    if geobox is None:
+        tile_path = dataset.metadata_doc["properties"]["s3_key"]
+        geobox = load_datasets(dataset, app_name=f"s2cloudless-writer_{tile_path}").geobox
+    geo_transform = geobox.transform.to_gdal()
+    projection = geobox.crs.wkt
+    output_path = get_output_path(dataset, file_suffix)
     array_to_geotiff_multiband(
-        str(Path(output_dir / f"{tile_id}_{file_suffix}.tif")),
+        output_path,
         data,
         geo_transform,
         projection,
-        data_type=data_type)
+        data_type=data_type,
+        cog=WRITE_COG,
+        compress=OUTPUT_COMPRESS,
+        block_size=OUTPUT_BLOCK_SIZE,
+        overview_resampling="AVERAGE" if data_type == gdal.GDT_Float32 else "NEAREST")
+    return output_path
+
+
+def generate_mask_dataset_doc(dataset: ODCDataset, output_path: str, geobox: GeoBox,
+                              mask_encoding: str = MASK_ENCODING) -> dict:
+    """ Generate an EO3 document of a mask .tif for the product of mask_encoding
+    with the L1C dataset it was generated from as lineage. The id is derived from
+    the source id and the product, so regenerated masks update the same dataset. """
+    tile_props = dataset.metadata_doc["properties"]
+    uri = Path(output_path).absolute().as_uri()
+    product = MASK_PRODUCTS[mask_encoding]
+    band_count = 2 if mask_encoding == "packed" else 3
+    return {
+        "id": md5(f"{dataset.id}/{product}".encode("utf-8")).hexdigest(),
+        "$schema": "https://schemas.opendatacube.org/dataset",
+        "product": {
+            "name": product,
+        },
+        "crs": str(geobox.crs),
+        "grids": {
+            "default": {
+                "shape": [geobox.height, geobox.width],
+                "transform": list(geobox.transform),
+            },
+        },
+        "measurements": {f"B{band:02d}": {"path": uri, "band": band} for band in range(1, band_count + 1)},
+        "location": uri,
+        "properties": {
+            "tile_id": tile_props["tile_id"],
+            "eo:instrument": tile_props["eo:instrument"],
+            "eo:platform": tile_props["eo:platform"],
+            "odc:file_format": "GeoTIFF",
+            "datetime": tile_props["datetime"],
+            "odc:region_code": tile_props["odc:region_code"],
+            "eo:cloud_cover": tile_props["cloudy_pixel_percentage"],
+            "s3_key": tile_props["s3_key"],
+        },
+        "lineage": {
+            "level1": [str(dataset.id)],
+        },
+    }
+
+
+def index_mask_datasets(docs: List[dict], index: datacube.index.index.Index,
+                        batch_size: int = INDEX_BATCH_SIZE) -> List[Tuple[ODCDataset, Exception]]:
+    """ Index mask dataset documents in batches. Lineage is not verified, source
+    L1C datasets only have to be in the index. """
+    return add_datasets([(doc, doc["location"]) for doc in docs], index, batch_size,
+                        products=[MASK_PRODUCT], verify_lineage=False)
+
+
+def write_blocks_to_tif(
+        dataset: ODCDataset,
+        data: DataArray,
+        geobox: GeoBox,
+        data_type: int = gdal.GDT_Byte,
+        file_suffix: str = "s2cloudless") -> str:
+    """ Write a lazy (band, y, x) DataArray to .tif block by block, computing the
+    next block while the current one is written. Blocks follow the dask chunks,
+    which should be multiples of OUTPUT_BLOCK_SIZE. Returns the output path. """
+    output_path = get_output_path(dataset, file_suffix)
+    block_size = data.chunks[-1][0] if data.chunks else OUTPUT_BLOCK_SIZE
+    array_to_geotiff_blocks(
+        output_path,
+        dataarray_blocks(data, block_size),
+        data.shape[-2:],
+        data.shape[0],
+        geobox.transform.to_gdal(),
+        geobox.crs.wkt,
+        data_type=data_type,
+        compress=OUTPUT_COMPRESS,
+        block_size=OUTPUT_BLOCK_SIZE,
+        overview_resampling=("AVERAGE" if data_type == gdal.GDT_Float32 else "NEAREST") if WRITE_COG else None,
+        cog=WRITE_COG)
+    return output_path
+
+
+def write_masks_windowed(
+        dataset: ODCDataset,
+        ds: Dataset,
+        geobox: GeoBox,
+        memory_budget: int,
+        file_suffix: str = "s2cloudless") -> str:
+    """ Generate masks of a lazily loaded granule in windows and write the output
+    bands of each window to .tif as soon as it is done, so that no mask of the
+    whole granule is held in memory. Window cores are aligned to output tiles and
+    upsampled from the resolution of ds to geobox. Returns the output path. """
+    tile_props = dataset.metadata_doc["properties"]
+    LOGGER.info(f"Processing {tile_props['s3_key']}\t{tile_props['cloudy_pixel_percentage']}% cloudy")
+    factor = int(round(abs(ds.geobox.resolution[1]) / OUTPUT_RESOLUTION))
+    windows = generate_mask_windows(ds, tile_props, memory_budget,
+                                    projection_distance=CLOUD_PROJECTION_DISTANCE / factor,
+                                    with_probability=WRITE_PROBABILITY,
+                                    align=OUTPUT_BLOCK_SIZE // gcd(OUTPUT_BLOCK_SIZE, factor))
+    blocks = ((target[0].start * factor, target[1].start * factor,
+               np.stack(encode_masks([upsample_mask(mask, factor) for mask in masks])))
+              for target, masks in windows)
+    output_path = get_output_path(dataset, file_suffix)
+    array_to_geotiff_blocks(
+        output_path,
+        blocks,
+        (geobox.height, geobox.width),
+        2 if MASK_ENCODING == "packed" else 3,
+        geobox.transform.to_gdal(),
+        geobox.crs.wkt,
+        data_type=gdal.GDT_Byte,
+        compress=OUTPUT_COMPRESS,
+        block_size=OUTPUT_BLOCK_SIZE,
+        overview_resampling="NEAREST" if WRITE_COG else None,
+        prefetch=False,  # blocks are computed by the generator, not in a thread
+        cog=WRITE_COG)
+    LOGGER.info("Mask generation done")
+    return output_path
 
 
-def write_dataset_rgb(dataset: ODCDataset):
-    """ Writes a ODC dataset to a rgb .tif file """
+def write_dataset_rgb(dataset: ODCDataset, ds: Dataset = None, dc: datacube.Datacube = None) -> str:
+    """ Writes a ODC dataset to a rgb .tif file. Bands are taken from ds if given,
+    otherwise loaded with dc. Dask backed bands, e.g. from windowed mode, are
+    written block by block without loading the whole granule. """
     rgb_bands = ['B02', 'B03', 'B04']
-    rgb_ds = load_datasets(dataset, measurements=rgb_bands, app_name=f"s2cloudless-writer_rgb")
-    write_to_tif(
+    if ds is None:
+        ds = load_datasets(dataset, measurements=rgb_bands, app_name=f"s2cloudless-writer_rgb",
+                           dask_chunks={"x": OUTPUT_BLOCK_SIZE, "y": OUTPUT_BLOCK_SIZE}, dc=dc)
+    if ds.chunks:
+        rgb = ds[rgb_bands].to_array().squeeze("time", drop=True).astype("float32") / np.float32(10000)
+        return write_blocks_to_tif(dataset, rgb, ds.geobox, data_type=gdal.GDT_Float32, file_suffix="rgb")
+    return write_to_tif(
         dataset,
-        [np.squeeze(rgb_ds[band].values / 10000) for band in rgb_ds.data_vars],
+        [np.squeeze(ds[band].values.astype("float32") / np.float32(10000)) for band in rgb_bands],
         data_type=gdal.GDT_Float32,
-        file_suffix="rgb")
+        file_suffix="rgb",
+        geobox=ds.geobox)
+
+
+def process_and_write(dataset: ODCDataset,
+                      memory_budget: int = WINDOW_MEMORY_BUDGET,
+                      dc: datacube.Datacube = None) -> (List[str], dict):
+    """ Generate masks for a granule and write them, and optionally rgb, to .tif.
+    The granule is loaded once and shared by all steps. With a memory budget masks
+    are written window by window. Returns the output paths and the EO3 document
+    of the mask dataset. """
+    check_cloud_percentage(dataset.metadata_doc["properties"])
+    ds = load_granule(dataset, memory_budget, dc=dc)
+    geobox = get_output_geobox(ds.geobox)
+    file_suffix = "s2cloudless_qa" if MASK_ENCODING == "packed" else "s2cloudless"
+    if memory_budget:
+        mask_path = write_masks_windowed(dataset, ds, geobox, memory_budget, file_suffix)
+    else:
+        masks = encode_masks(process_dataset(dataset, memory_budget, ds=ds))
+        LOGGER.info("Writing output")
+        mask_path = write_to_tif(dataset, masks, geobox=geobox, file_suffix=file_suffix)
+    outputs = [mask_path]
+    if WRITE_RGB:
+        LOGGER.info(f"Writing rgb output")
+        # rgb is written at the output resolution, so a coarser granule can't be reused
+        rgb_ds = ds if WORKING_RESOLUTION == OUTPUT_RESOLUTION else None
+        outputs.append(write_dataset_rgb(dataset, ds=rgb_ds, dc=dc))  # TODO: write corresponding L2A dataset
+    LOGGER.info("Finished processing")
+    return outputs, generate_mask_dataset_doc(dataset, mask_path, geobox)
+
+
+def estimate_granule_memory(window_memory_budget: int = WINDOW_MEMORY_BUDGET) -> int:
+    """ Estimate peak memory in bytes of processing and writing one granule """
+    if window_memory_budget:
+        # masks are written window by window and rgb block by block through the GDAL block cache
+        window_pixels = window_memory_budget // WINDOW_BYTES_PER_PIXEL * (WORKING_RESOLUTION // OUTPUT_RESOLUTION) ** 2
+        # upsampled masks, output bands and their stacked block of one window at the output resolution
+        return window_memory_budget + window_pixels * 9 + gdal.GetCacheMax()
+    output_bytes = GRANULE_PIXELS * 3  # cloud and shadow masks, probabilities
+    if MASK_ENCODING == "packed":
+        output_bytes += GRANULE_PIXELS  # QA band
+    # rgb is streamed block by block unless it is taken from a granule loaded to memory
+    rgb_in_memory = WRITE_RGB and WORKING_RESOLUTION == OUTPUT_RESOLUTION
+    if rgb_in_memory:
+        output_bytes += GRANULE_PIXELS * 3 * 8
+    if WRITE_COG:  # COGs are built in memory before they are written
+        output_bytes += GRANULE_PIXELS * 3 * 4 if rgb_in_memory else GRANULE_PIXELS * 3
+    working_pixels = GRANULE_PIXELS // (WORKING_RESOLUTION // OUTPUT_RESOLUTION) ** 2
+    input_bytes = working_pixels * 13 * 2  # uint16 bands kept in memory for the rgb writer
+    return input_bytes + working_pixels * WINDOW_BYTES_PER_PIXEL + output_bytes
+
+
+def get_process_count(processes: int = PROCESSES, memory_budget: int = MEMORY_BUDGET) -> int:
+    """ Number of granules to process in parallel within the memory budget """
+    if memory_budget:
+        processes = min(processes, memory_budget // estimate_granule_memory())
+    return max(processes, 1)
+
 
+def get_input_checksum(dataset: ODCDataset) -> str:
+    """ Checksum of the indexed metadata of a dataset, changes when it is reindexed
+    with different metadata """
+    return md5(json.dumps(dataset.metadata_doc, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
-def main():
+
+_worker_dc = None
+_worker_manifest = None
+
+
+def _init_worker(manifest_path: Path = None):
+    global _worker_dc, _worker_manifest
+    _worker_dc = datacube.Datacube(app="s2cloudless-worker")
+    if manifest_path is not None:
+        _worker_manifest = Manifest(manifest_path)
+
+
+def process_granule(dataset_id: str) -> dict:
+    """ Generate and write masks for a single granule in a worker process.
+    Returns a result with the status success, skipped, failed, or done if the
+    manifest shows the granule was already completed from the same input, and
+    the EO3 document of the mask dataset on success. """
+    start = time.perf_counter()
+    result = {"id": dataset_id, "status": "success", "error": None, "checksum": None, "outputs": [],
+              "dataset_doc": None}
+    try:
+        dataset = _worker_dc.index.datasets.get(dataset_id)
+        result["checksum"] = get_input_checksum(dataset)
+        if _worker_manifest is not None and _worker_manifest.is_done(dataset_id, result["checksum"]):
+            result["status"] = "done"
+        else:
+            result["outputs"], result["dataset_doc"] = process_and_write(dataset, dc=_worker_dc)
+    except CloudPercentageSkip:
+        result["status"] = "skipped"
+    except Exception as e:
+        LOGGER.exception(f"Failed to process {dataset_id}")
+        result["status"] = "failed"
+        result["error"] = repr(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def find_granule_ids(dc: datacube.Datacube) -> List[str]:
+    """ Ids of granules with a metadata cloud percentage within the thresholds. The
+    range is searched in the index through the eo3 cloud_cover field, so skipped
+    granules are never loaded. Granules indexed before eo:cloud_cover was written
+    have to be reindexed to be found, which is logged as a warning. """
+    results = dc.index.datasets.search_returning(
+        ("id",),
+        product="s2a_level1c_granule",
+        cloud_cover=Range(MIN_CLOUD_THRESHOLD, MAX_CLOUD_THRESHOLD))
+    dataset_ids = [str(result.id) for result in results]
+    total = dc.index.datasets.count(product="s2a_level1c_granule")
+    with_cloud_cover = dc.index.datasets.count(product="s2a_level1c_granule", cloud_cover=Range(0, 100))
+    if with_cloud_cover < total:
+        LOGGER.warning(f"{total - with_cloud_cover} of {total} granules have no eo:cloud_cover and are not "
+                       f"processed, reindex them with index_l1c.py")
+    return dataset_ids
+
+
+def main(processes: int = PROCESSES, memory_budget: int = MEMORY_BUDGET,
+         manifest_path: Path = MANIFEST_PATH, index_masks: bool = INDEX_MASKS) -> List[dict]:
+    """ Process all granules in parallel. Results are recorded in the manifest, so
+    a restarted run skips completed granules and retries failed ones. Written masks
+    are indexed as MASK_PRODUCT datasets in batches if index_masks is set, starting
+    with masks whose indexing failed or was interrupted in a previous run. """
     LOGGER.info("Starting")
     dc = datacube.Datacube(app="s2cloudless-main")
-    l1c_datasets = dc.find_datasets(product="s2a_level1c_granule")
+    dataset_ids = find_granule_ids(dc)
+    processes = get_process_count(processes, memory_budget)
+    LOGGER.info(f"Processing {len(dataset_ids)} granules with {processes} processes")
 
-    for dataset in l1c_datasets:
-        try:
-            masks = list(process_dataset(dataset))
-        except ValueError:  # TODO: catch and handle custom exceptions
-            continue
-        LOGGER.info("Writing output")
-        write_to_tif(dataset, masks)
-        if WRITE_RGB:
-            LOGGER.info(f"Writing rgb output")
-            write_dataset_rgb(dataset)  # TODO: write corresponding L2A dataset
-        LOGGER.info("Finished processing")
-        break
+    manifest = Manifest(manifest_path)
+    results = []
+    docs = []  # (granule id, mask dataset document) pairs
+
+    def index_docs():
+        mask_docs = [doc for _, doc in docs]
+        for mask_dataset, err in index_mask_datasets(mask_docs, dc.index):
+            if err is not None:
+                LOGGER.error(f"Failed to index mask dataset {mask_dataset}: {err}")
+        indexed = dc.index.datasets.bulk_has([doc["id"] for doc in mask_docs])
+        manifest.mark_indexed([dataset_id for (dataset_id, _), exists in zip(docs, indexed) if exists])
+        docs.clear()
+
+    if index_masks:
+        docs.extend(manifest.get_unindexed_docs())
+        if docs:
+            LOGGER.info(f"Indexing {len(docs)} mask datasets left unindexed by a previous run")
+            index_docs()
+
+    with Pool(processes, initializer=_init_worker, initargs=(manifest_path,)) as pool:
+        for result in pool.imap_unordered(process_granule, dataset_ids):
+            results.append(result)
+            if result["status"] != "done":
+                manifest.record(result)
+            if index_masks and result["dataset_doc"] is not None:
+                docs.append((result["id"], result.pop("dataset_doc")))
+                if len(docs) >= INDEX_BATCH_SIZE:
+                    index_docs()
+            LOGGER.info(f"{len(results)}/{len(dataset_ids)} {result['id']} {result['status']} "
+                        f"in {result['seconds']:.1f} s")
+    if docs:
+        index_docs()
+    manifest.close()
+
+    statuses = [result["status"] for result in results]
+    LOGGER.info(f"Finished: {statuses.count('success')} succeeded, {statuses.count('skipped')} skipped, "
+                f"{statuses.count('failed')} failed, {statuses.count('done')} already done")
+    return results
 
 
 if __name__ == "__main__":
@@ -5,3 +5,4 @@ datacube -v system init
 datacube product add https://raw.githubusercontent.com/digitalearthafrica/config/master/products/esa_s2_l2a.yaml
 datacube product add ../products/s2_granules.yaml
 datacube product add ../products/s2cloudless_masks.yaml
+datacube product add ../products/s2cloudless_qa_masks.yaml
@@ -1,15 +1,54 @@
-from typing import List, Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, Tuple
 import numpy as np
 import gdal
 gdal.UseExceptions()
 
+FLOAT_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+
+
+def get_overview_levels(rows: int, cols: int, block_size: int) -> List[int]:
+    """ Overview decimation factors halving the raster until it fits in a block """
+    levels = []
+    factor = 2
+    while max(rows, cols) / factor >= block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def get_tiled_options(data_type: int, compress: str = "DEFLATE", block_size: int = 512) -> List[str]:
+    """ GTiff creation options for an internally tiled, compressed GeoTIFF.
+    The predictor is horizontal differencing for integers and floating point
+    prediction for floats. """
+    predictor = 3 if data_type in FLOAT_TYPES else 2
+    return [
+        "TILED=YES",
+        f"BLOCKXSIZE={block_size}",
+        f"BLOCKYSIZE={block_size}",
+        f"COMPRESS={compress}",
+        f"PREDICTOR={predictor}",
+        "BIGTIFF=IF_SAFER",
+    ]
+
+
+def get_cog_options(data_type: int, compress: str = "DEFLATE", block_size: int = 512) -> List[str]:
+    """ GTiff creation options for a cloud optimised GeoTIFF copied from a
+    dataset with overviews """
+    return get_tiled_options(data_type, compress, block_size) + ["COPY_SRC_OVERVIEWS=YES"]
+
 
 def array_to_geotiff_multiband(file_name: str,
                                data: List[np.ndarray],
                                geo_transform: Tuple,
                                projection: str,
                                nodata_val=0,
-                               data_type=gdal.GDT_Float32):
+                               data_type=gdal.GDT_Float32,
+                               cog: bool = False,
+                               compress: str = "DEFLATE",
+                               block_size: int = 512,
+                               overview_resampling: str = "NEAREST"):
     """ Create a multiband GeoTIFF file with data from an array.
     file_name : output geotiff file path including extension
     data : list of numpy arrays
@@ -19,14 +58,120 @@ def array_to_geotiff_multiband(file_name: str,
     nodata_val : Value to convert to nodata in the output raster; default 0
     data_type : gdal data_type object, optional
         Optionally set the data_type of the output raster; can be
-        useful when exporting an array of float or integer values. """
-    driver = gdal.GetDriverByName('GTiff')
+        useful when exporting an array of float or integer values.
+    cog : write a cloud optimised GeoTIFF with internal tiles, compression and
+        overviews instead of a plain striped, uncompressed GeoTIFF
+    compress : compression of a COG, e.g. DEFLATE or ZSTD if GDAL supports it
+    block_size : tile width and height of a COG, a multiple of 16
+    overview_resampling : resampling of COG overviews, NEAREST for masks and
+        AVERAGE for continuous data """
     rows, cols = data[0].shape  # Create raster of given size and projection
-    dataset = driver.Create(file_name, cols, rows, len(data), data_type)
+    if cog:
+        # overviews have to be written before the full resolution data for a
+        # COG layout, so the raster is built in memory and copied
+        driver = gdal.GetDriverByName('MEM')
+        dataset = driver.Create('', cols, rows, len(data), data_type)
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(file_name, cols, rows, len(data), data_type)
     dataset.SetGeoTransform(geo_transform)
     dataset.SetProjection(projection)
     for idx, d in enumerate(data):
         band = dataset.GetRasterBand(idx + 1)
         band.WriteArray(d)
         band.SetNoDataValue(nodata_val)
+    if cog:
+        dataset.BuildOverviews(overview_resampling, get_overview_levels(rows, cols, block_size))
+        output = gdal.GetDriverByName('GTiff').CreateCopy(
+            file_name, dataset, options=get_cog_options(data_type, compress, block_size))
+        output = None
+    dataset = None  # Close %%file
+
+
+def dataarray_blocks(data, block_size: int = 512) -> Iterator[Tuple[int, int, Any]]:
+    """ Split a (band, y, x) or (y, x) xarray.DataArray, or a dask or numpy array,
+    into block_size x block_size blocks. Yields the row and column offset of each
+    block and the block, which stays lazy for dask backed data. """
+    rows, cols = data.shape[-2:]
+    for row in range(0, rows, block_size):
+        for col in range(0, cols, block_size):
+            yield row, col, data[..., row:row + block_size, col:col + block_size]
+
+
+def _materialise(block) -> np.ndarray:
+    """ Compute a lazy block and return it as a (band, y, x) numpy array """
+    if hasattr(block, "compute"):
+        block = block.compute()
+    block = np.asarray(block)
+    return block.reshape((-1,) + block.shape[-2:])
+
+
+def array_to_geotiff_blocks(file_name: str,
+                            blocks: Iterable[Tuple[int, int, Any]],
+                            shape: Tuple[int, int],
+                            band_count: int,
+                            geo_transform: Tuple,
+                            projection: str,
+                            nodata_val=0,
+                            data_type=gdal.GDT_Float32,
+                            compress: str = "DEFLATE",
+                            block_size: int = 512,
+                            overview_resampling: str = None,
+                            prefetch: bool = True,
+                            cog: bool = False):
+    """ Create a tiled, compressed multiband GeoTIFF block by block, so that data
+    larger than memory can be written without computing it all at once.
+    file_name : output geotiff file path including extension
+    blocks : (row offset, column offset, block) tuples, e.g. from dataarray_blocks.
+        A block is a (band, y, x) or (y, x) numpy array, or a dask array or
+        xarray.DataArray that is computed when it is written
+    shape : (rows, cols) of the output raster
+    band_count : number of bands in the output raster
+    geo_transform, projection, nodata_val, data_type : as in array_to_geotiff_multiband
+    compress, block_size : compression and tile size of the output, blocks
+        aligned to block_size are written without partial tiles
+    overview_resampling : build overviews with this resampling after all blocks
+        are written if given
+    prefetch : compute the next block in a thread while the current one is written
+    cog : write the blocks and overviews to a temporary file and copy it to a
+        cloud optimised GeoTIFF, which is read and written tile by tile. Overviews
+        are built with NEAREST resampling unless overview_resampling is given """
+    rows, cols = shape
+    driver = gdal.GetDriverByName('GTiff')
+    if cog:
+        if overview_resampling is None:
+            overview_resampling = "NEAREST"
+        output_name, file_name = file_name, f"{file_name}.tmp.tif"
+    dataset = driver.Create(file_name, cols, rows, band_count, data_type,
+                            options=get_tiled_options(data_type, compress, block_size))
+    dataset.SetGeoTransform(geo_transform)
+    dataset.SetProjection(projection)
+    for idx in range(band_count):
+        dataset.GetRasterBand(idx + 1).SetNoDataValue(nodata_val)
+
+    def write(row: int, col: int, block: np.ndarray):
+        for idx in range(band_count):
+            dataset.GetRasterBand(idx + 1).WriteArray(block[idx], xoff=col, yoff=row)
+
+    if prefetch:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            for row, col, block in blocks:
+                future = executor.submit(_materialise, block)
+                if pending is not None:
+                    write(pending[0], pending[1], pending[2].result())
+                pending = (row, col, future)
+            if pending is not None:
+                write(pending[0], pending[1], pending[2].result())
+    else:
+        for row, col, block in blocks:
+            write(row, col, _materialise(block))
+
+    if overview_resampling is not None:
+        dataset.BuildOverviews(overview_resampling, get_overview_levels(rows, cols, block_size))
+    if cog:
+        output = driver.CreateCopy(output_name, dataset, options=get_cog_options(data_type, compress, block_size))
+        output = None
+        dataset = None
+        os.remove(file_name)
     dataset = None  # Close %%file
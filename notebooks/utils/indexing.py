@@ -0,0 +1,111 @@
+import logging
+import time
+from contextlib import nullcontext
+from typing import List, Tuple
+
+import datacube
+from datacube.index.hl import Doc2Dataset
+from datacube.model import Dataset
+from datacube.utils import changes
+
+from utils.metrics import Metrics
+
+_warned_no_transaction = False
+
+
+def _warn_no_transaction():
+    global _warned_no_transaction
+    if not _warned_no_transaction:
+        logging.warning("The installed datacube has no index transactions, datasets are added one by one")
+        _warned_no_transaction = True
+
+
+def _add_or_update(dataset, index: datacube.index.index.Index, exists: bool = False):
+    """ Add a dataset, or update it if exists is set. index.datasets.add only logs
+    a warning for an existing id, so the document is replaced explicitly. """
+    err = None
+    try:
+        if exists:
+            index.datasets.update(dataset, {tuple(): changes.allow_any})
+        else:
+            index.datasets.add(dataset)  # Source policy to be checked in sentinel 2 datase types
+    except changes.DocumentMismatchError:
+        index.datasets.update(dataset, {tuple(): changes.allow_any})
+    except Exception as e:
+        err = e
+        logging.error("Unhandled exception %s", e)
+    return err
+
+
+def _resolve(resolver: Doc2Dataset, doc: dict, uri: str) -> Tuple[Dataset, Exception]:
+    """ Resolve a document like Doc2Dataset, returning exceptions it raises as the error """
+    try:
+        return resolver(doc, uri)
+    except Exception as e:
+        return None, e
+
+
+def add_dataset(doc, uri, index: datacube.index.index.Index, resolver: Doc2Dataset = None, **kwargs):
+    logging.info("Indexing %s", uri)
+    if resolver is None:
+        resolver = Doc2Dataset(index, **kwargs)
+    dataset, err = _resolve(resolver, doc, uri)
+    if err is not None:
+        logging.error("%s", err)
+        return dataset, err
+    return dataset, _add_or_update(dataset, index, index.datasets.has(dataset.id))
+
+
+def add_datasets(docs: List[Tuple[dict, str]], index: datacube.index.index.Index,
+                 batch_size: int = 100, metrics: Metrics = None, **kwargs) -> List[Tuple[Dataset, Exception]]:
+    """ Index (doc, uri) pairs in chunks of batch_size, one transaction per chunk.
+    All documents are resolved with a single shared Doc2Dataset resolver. Datasets
+    that are already indexed are updated. If a chunk fails it is rolled back and
+    its datasets are added one by one with add_dataset semantics. Without
+    transaction support in the installed datacube, e.g. 1.8, every dataset is added
+    on its own, which is logged once. Existing ids are looked up once per chunk.
+    Resolve and insert times are recorded in metrics if given.
+    Returns a (dataset, err) tuple for each document like add_dataset, a document
+    that fails to resolve gives (None, err) without stopping the others. """
+    resolver = Doc2Dataset(index, **kwargs)
+    transaction = getattr(index, "transaction", None)
+    if transaction is None:
+        _warn_no_transaction()
+    results = []
+    for offset in range(0, len(docs), batch_size):
+        start = time.perf_counter()
+        resolved = []
+        for doc, uri in docs[offset:offset + batch_size]:
+            with metrics.timer("resolve") if metrics is not None else nullcontext():
+                dataset, err = _resolve(resolver, doc, uri)
+            if err is not None:
+                logging.error("%s", err)
+                results.append((dataset, err))
+            else:
+                resolved.append(dataset)
+
+        insert_start = time.perf_counter()
+        batch_results = None
+        existing = index.datasets.bulk_has([dataset.id for dataset in resolved]) if resolved else []
+        if transaction is not None and resolved:
+            try:
+                with transaction():
+                    for dataset, exists in zip(resolved, existing):
+                        if exists:
+                            index.datasets.update(dataset, {tuple(): changes.allow_any})
+                        else:
+                            index.datasets.add(dataset)
+                batch_results = [(dataset, None) for dataset in resolved]
+            except Exception as e:
+                logging.warning("Batch insert failed, adding datasets one by one: %s", e)
+        if batch_results is None:
+            batch_results = [(dataset, _add_or_update(dataset, index, exists))
+                             for dataset, exists in zip(resolved, existing)]
+        results.extend(batch_results)
+        if metrics is not None:
+            metrics.observe("insert", time.perf_counter() - insert_start, len(resolved))
+
+        elapsed = time.perf_counter() - start
+        rate = len(resolved) / elapsed if elapsed > 0 else 0.0
+        logging.info("Indexed batch of %d datasets in %.2f s (%.1f rows/s)", len(resolved), elapsed, rate)
+    return results
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+DONE_STATUSES = ("success", "skipped")
+# columns added after the first version of the table, created on older manifests
+_ADDED_COLUMNS = {
+    "dataset_doc": "TEXT",
+    "indexed": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+class Manifest:
+    """ SQLite manifest of processed datasets keyed by dataset id, recording status,
+    output paths, timings, a checksum of the input, and the document of the output
+    dataset with whether it was indexed. Written by a single process, safe to read
+    from worker processes at the same time. """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path), timeout=60)
+        self._connection.row_factory = sqlite3.Row
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS datasets (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    checksum TEXT,
+                    outputs TEXT NOT NULL,
+                    seconds REAL,
+                    error TEXT,
+                    attempts INTEGER NOT NULL,
+                    updated TEXT NOT NULL,
+                    dataset_doc TEXT,
+                    indexed INTEGER NOT NULL DEFAULT 0
+                )""")
+            columns = {row["name"] for row in self._connection.execute("PRAGMA table_info(datasets)")}
+            for column, definition in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE datasets ADD COLUMN {column} {definition}")
+
+    def get(self, dataset_id: str) -> Optional[dict]:
+        row = self._connection.execute("SELECT * FROM datasets WHERE id = ?", (dataset_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["outputs"] = json.loads(entry["outputs"])
+        entry["dataset_doc"] = json.loads(entry["dataset_doc"]) if entry["dataset_doc"] else None
+        return entry
+
+    def is_done(self, dataset_id: str, checksum: str) -> bool:
+        """ Whether the dataset was completed from the same input and its outputs still exist """
+        entry = self.get(dataset_id)
+        return (entry is not None
+                and entry["status"] in DONE_STATUSES
+                and entry["checksum"] == checksum
+                and all(Path(output).exists() for output in entry["outputs"]))
+
+    def record(self, result: dict):
+        """ Store a result with id, status, checksum, outputs, seconds, error and the
+        document of the output dataset, which is marked as not indexed """
+        with self._connection:
+            self._connection.execute("""
+                INSERT INTO datasets (id, status, checksum, outputs, seconds, error, attempts, updated,
+                                      dataset_doc, indexed)
+                VALUES (:id, :status, :checksum, :outputs, :seconds, :error, 1, :updated, :dataset_doc, 0)
+                ON CONFLICT(id) DO UPDATE SET
+                    status = excluded.status,
+                    checksum = excluded.checksum,
+                    outputs = excluded.outputs,
+                    seconds = excluded.seconds,
+                    error = excluded.error,
+                    attempts = datasets.attempts + 1,
+                    updated = excluded.updated,
+                    dataset_doc = excluded.dataset_doc,
+                    indexed = 0""", {
+                "id": result["id"],
+                "status": result["status"],
+                "checksum": result.get("checksum"),
+                "outputs": json.dumps(result.get("outputs", [])),
+                "seconds": result.get("seconds"),
+                "error": result.get("error"),
+                "updated": datetime.now(timezone.utc).isoformat(),
+                "dataset_doc": json.dumps(result["dataset_doc"]) if result.get("dataset_doc") else None,
+            })
+
+    def get_unindexed_docs(self) -> List[Tuple[str, dict]]:
+        """ (id, document) pairs of successful datasets whose output is not indexed yet """
+        rows = self._connection.execute("""
+            SELECT id, dataset_doc FROM datasets
+            WHERE status = 'success' AND indexed = 0 AND dataset_doc IS NOT NULL""").fetchall()
+        return [(row["id"], json.loads(row["dataset_doc"])) for row in rows]
+
+    def mark_indexed(self, dataset_ids: List[str]):
+        """ Record that the outputs of datasets were indexed """
+        with self._connection:
+            self._connection.executemany("UPDATE datasets SET indexed = 1 WHERE id = ?",
+                                         [(dataset_id,) for dataset_id in dataset_ids])
+
+    def close(self):
+        self._connection.close()
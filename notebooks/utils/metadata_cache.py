@@ -0,0 +1,79 @@
+import os
+import logging
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Tuple
+
+
+class MetadataCache:
+    """ Content-addressed on-disk cache of S3 objects keyed by bucket, key and ETag.
+    Objects are evicted least recently used first once the cache grows beyond
+    max_bytes, down to low_water of max_bytes so that not every following write
+    has to scan the cache again. Reads and writes are safe across threads and processes sharing
+    the same directory; the size limit is enforced approximately per process. """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, low_water: float = 0.9):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, bucket_name: str, key: str, etag: str) -> Path:
+        etag = etag.strip('"')
+        digest = sha256(f"{bucket_name}/{key}/{etag}".encode("utf-8")).hexdigest()
+        return self.cache_dir / digest[:2] / digest
+
+    def _entries(self) -> List[Tuple[Path, int, float]]:
+        entries = []
+        for path in self.cache_dir.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, bucket_name: str, key: str, etag: str) -> Optional[bytes]:
+        """ Return the cached object or None if this version is not cached """
+        path = self._path(bucket_name, key, etag)
+        try:
+            raw = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # evicted by another process after the read
+            pass
+        return raw
+
+    def put(self, bucket_name: str, key: str, etag: str, raw: bytes):
+        path = self._path(bucket_name, key, etag)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(raw)
+        tmp_path.replace(path)
+        with self._lock:
+            self._size += len(raw)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Remove least recently used objects until the cache fits in low_water of max_bytes """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_water
+        for path, file_size, _ in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        logging.info("Metadata cache size after eviction: %d bytes", size)
+        self._size = size
@@ -0,0 +1,151 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional
+
+
+class Metrics:
+    """ Per-process stage timings, rolling rates and sampled gauges, e.g. queue
+    depths. Thread safe. Can be dumped to JSON or written as a Prometheus text
+    file for the node_exporter textfile collector. """
+
+    def __init__(self, namespace: str, window: float = 60.0, **labels: str):
+        self.namespace = namespace
+        self.window = window  # seconds over which rolling rates are computed
+        self.reset(**labels)
+
+    def reset(self, **labels: str):
+        """ Clear all values, e.g. at the start of a forked worker process. Not safe
+        to call while other threads are recording. """
+        self._lock = Lock()  # a lock inherited from the parent process may be held
+        self.labels = labels
+        self.started = time.time()
+        self._stages = {}
+        self._events = {}
+        self._gauges = {}
+
+    @contextmanager
+    def timer(self, stage: str, n: int = 1):
+        """ Time a block of work on n items """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, n)
+
+    def observe(self, stage: str, seconds: float, n: int = 1):
+        now = time.time()
+        with self._lock:
+            stats = self._stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += n
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            events = self._events.setdefault(stage, deque())
+            events.append((now, n))
+            while events and events[0][0] < now - self.window:
+                events.popleft()
+
+    def sample(self, gauge: str, value: float):
+        with self._lock:
+            stats = self._gauges.setdefault(gauge, {"value": value, "max": value, "sum": 0.0, "samples": 0})
+            stats["value"] = value
+            stats["max"] = max(stats["max"], value)
+            stats["sum"] += value
+            stats["samples"] += 1
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        with self._lock:
+            stages = {}
+            for stage, stats in self._stages.items():
+                events = self._events[stage]
+                recent = sum(n for timestamp, n in events if timestamp >= now - self.window)
+                stages[stage] = {
+                    **stats,
+                    "mean_seconds": stats["seconds"] / stats["count"] if stats["count"] else 0.0,
+                    "rate": recent / min(self.window, max(now - self.started, 1e-9)),
+                }
+            gauges = {gauge: {"value": stats["value"], "max": stats["max"],
+                              "mean": stats["sum"] / stats["samples"]}
+                      for gauge, stats in self._gauges.items()}
+            return {
+                "labels": dict(self.labels),
+                "uptime_seconds": now - self.started,
+                "stages": stages,
+                "gauges": gauges,
+            }
+
+    def dump_json(self, path: Path):
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+    def to_prometheus(self) -> str:
+        metrics = self.to_dict()
+        lines = []
+
+        def add(name: str, metric_type: str, help_text: str, values: Dict[str, float], label: str):
+            name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in values.items():
+                labels = ",".join(f'{k}="{v}"' for k, v in {**metrics["labels"], label: key}.items())
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        stages = metrics["stages"]
+        gauges = metrics["gauges"]
+        add("stage_items_total", "counter", "Items processed per stage.",
+            {stage: stats["count"] for stage, stats in stages.items()}, "stage")
+        add("stage_seconds_total", "counter", "Seconds spent per stage.",
+            {stage: stats["seconds"] for stage, stats in stages.items()}, "stage")
+        add("stage_rate", "gauge", f"Items per second per stage over the last {self.window:.0f} s.",
+            {stage: stats["rate"] for stage, stats in stages.items()}, "stage")
+        add("gauge", "gauge", "Last sampled value.",
+            {gauge: stats["value"] for gauge, stats in gauges.items()}, "name")
+        add("gauge_max", "gauge", "Maximum sampled value.",
+            {gauge: stats["max"] for gauge, stats in gauges.items()}, "name")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path):
+        _write_atomic(path, self.to_prometheus())
+
+    def start_reporter(self, output_dir: Optional[Path], name: str, interval: float,
+                       queues: Dict[str, object] = None) -> Callable[[], None]:
+        """ Sample queue depths every interval seconds and write {name}.json and
+        {name}.prom to output_dir if given. Returns a function that stops the
+        reporter after writing a final report. """
+        stop = Event()
+        queues = queues or {}
+
+        def report():
+            for gauge, queue in queues.items():
+                try:
+                    self.sample(f"{gauge}_queue_depth", queue.qsize())
+                except (NotImplementedError, EOFError, OSError):  # qsize unsupported or manager gone
+                    pass
+            if output_dir is not None:
+                self.dump_json(Path(output_dir) / f"{name}.json")
+                self.write_prometheus(Path(output_dir) / f"{name}.prom")
+
+        def run():
+            while not stop.wait(interval):
+                report()
+            report()
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+
+        def stop_reporter():
+            stop.set()
+            thread.join()
+
+        return stop_reporter
+
+
+def _write_atomic(path: Path, content: str):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(content)
+    tmp_path.replace(path)